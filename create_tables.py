@@ -1,9 +1,48 @@
 # create_tables.py
+from sqlalchemy import text
+
 from db import engine
 from models import Base
 
+# create_all() only creates missing tables; it never alters existing ones.
+# Constraints/indexes added to models later are applied here, idempotently.
+#
+# uq_promo_device: redeem relies on it to reject a device reusing a code.
+# The ALTER fails if duplicate (promo_code_id, device_id) rows already
+# exist; remove those first, e.g. list them with
+#   SELECT promo_code_id, device_id, count(*) FROM promo_redemptions
+#   GROUP BY 1, 2 HAVING count(*) > 1;
+_UPGRADE_STATEMENTS = [
+    """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_constraint WHERE conname = 'uq_promo_device'
+        ) THEN
+            ALTER TABLE promo_redemptions
+                ADD CONSTRAINT uq_promo_device UNIQUE (promo_code_id, device_id);
+        END IF;
+    END
+    $$
+    """,
+    # ix_promo_codes_code_covering replaces the plain unique index that
+    # code's old unique=True/index=True created; build it before dropping
+    # the old one so code stays unique throughout.
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS ix_promo_codes_code_covering
+        ON promo_codes (code)
+        INCLUDE (bonus_questions, expires_at, max_redemptions)
+    """,
+    "DROP INDEX IF EXISTS ix_promo_codes_code",
+]
+
+
 def main():
     Base.metadata.create_all(bind=engine)
 
+    with engine.begin() as conn:
+        for stmt in _UPGRADE_STATEMENTS:
+            conn.execute(text(stmt))
+
 if __name__ == "__main__":
     main()
@@ -1,9 +1,27 @@
 # db.py
 import os
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker
 
 DATABASE_URL = os.getenv("DATABASE_URL")  # set this in Render
 
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+engine = create_engine(
+    DATABASE_URL,
+    # psycopg2 fast execution helpers: INSERTs go through multi-VALUES
+    # batches, other executemany DML through execute_batch()
+    executemany_mode="values_plus_batch",
+    executemany_batch_page_size=1000,
+    insertmanyvalues_page_size=1000,
+    # Keep a warm pool sized for concurrent redeems; ping before checkout so
+    # connections dropped by the server don't surface as OperationalError
+    pool_size=int(os.getenv("DB_POOL_SIZE", "20")),
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "10")),
+    pool_timeout=30,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+)
+# Thread-local registry: handlers reuse their worker thread's Session and
+# must call SessionLocal.remove() when done
+SessionLocal = scoped_session(
+    sessionmaker(bind=engine, autoflush=False, autocommit=False)
+)
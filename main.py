@@ -1,16 +1,24 @@
 # main.py
 from datetime import datetime, timezone
+import html
 import os
 import secrets
+from string import Template
+import threading
+from typing import Annotated, NoReturn
+from urllib.parse import quote_plus
 
-from fastapi import FastAPI, HTTPException, Form, Query
-from fastapi.responses import HTMLResponse
-from pydantic import BaseModel
-from sqlalchemy import select
-from sqlalchemy.exc import SQLAlchemyError
+from cachetools import TTLCache
 
-from db import SessionLocal
-from models import PromoCode, PromoRedemption
+from fastapi import FastAPI, HTTPException, Form, Query, Request
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
+from pydantic import BaseModel, StringConstraints
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from db import SessionLocal, engine
+from models import PromoCode
 
 app = FastAPI(title="Stablfy Promo Service", version="1.0.0")
 
@@ -26,12 +34,33 @@ def require_admin(token: str):
         raise HTTPException(status_code=403, detail="forbidden")
 
 
+# Codes recently found unredeemable (unknown, expired or used up), mapped to
+# the error detail. Lets repeat/brute-force attempts fail without touching
+# the DB. Advisory only: the atomic UPDATE in redeem_promo stays the source
+# of truth. TTLCache isn't thread-safe and sync handlers run in a threadpool.
+_rejected_codes = TTLCache(maxsize=10_000, ttl=60)
+_rejected_codes_lock = threading.Lock()
+
+
+def _is_well_formed_code(code_val: str) -> bool:
+    # Anything that could match a stored row: non-empty and fits
+    # promo_codes.code. Prefixes are free text, so no charset check.
+    return 0 < len(code_val) <= 64
+
+
+def _reject(code_val: str, detail: str) -> NoReturn:
+    with _rejected_codes_lock:
+        _rejected_codes[code_val] = detail
+    raise HTTPException(status_code=400, detail=detail)
+
+
 # --------------------------------------------------------------------
 # Schemas for the iOS app
 # --------------------------------------------------------------------
 
 class PromoRedeemIn(BaseModel):
-    code: str
+    # Normalised once at parse time (pydantic-core) rather than in the handler
+    code: Annotated[str, StringConstraints(strip_whitespace=True, to_upper=True)]
     device_id: str
 
 
@@ -44,63 +73,96 @@ class PromoRedeemOut(BaseModel):
 # Health check
 # --------------------------------------------------------------------
 
-@app.get("/healthz")
-async def healthz():
-    return {"ok": True}
+# Plain Starlette route with a pre-encoded response: no dependency
+# resolution, validation or JSON encoding per load-balancer poll.
+_HEALTHZ_RESPONSE = Response(content=b'{"ok":true}', media_type="application/json")
+
+
+async def healthz(request: Request) -> Response:
+    return _HEALTHZ_RESPONSE
+
+
+app.add_route("/healthz", healthz, methods=["GET"])
 
 
 # --------------------------------------------------------------------
 # Public: redeem promo code (used by iOS app)
 # --------------------------------------------------------------------
 
+# The redeem path is plain SQL on a pooled connection (Core, no ORM session,
+# identity map or unit of work): it reads a few columns and writes two rows.
+_CLAIM_REDEMPTION_STMT = text("""
+    UPDATE promo_codes
+       SET redemptions_used = redemptions_used + 1
+     WHERE code = :code
+       AND (expires_at IS NULL OR expires_at > :now)
+       AND redemptions_used < max_redemptions
+    RETURNING id, bonus_questions, expires_at
+""")
+
+_PROMO_EXPIRY_STMT = text("SELECT expires_at FROM promo_codes WHERE code = :code")
+
+_INSERT_REDEMPTION_STMT = text("""
+    INSERT INTO promo_redemptions (promo_code_id, device_id, redeemed_at)
+    VALUES (:promo_code_id, :device_id, :redeemed_at)
+""")
+
+
+# Plain `def`: the DB driver is blocking, so let FastAPI run this in
+# its threadpool instead of stalling the event loop on every DB round-trip.
 @app.post("/promo/redeem", response_model=PromoRedeemOut)
-async def redeem_promo(body: PromoRedeemIn):
-    code_val = body.code.strip().upper()
+def redeem_promo(body: PromoRedeemIn):
+    code_val = body.code
     now = datetime.now(timezone.utc)
 
-    try:
-        with SessionLocal() as db:
-            # 1) Look up promo code
-            stmt = select(PromoCode).where(PromoCode.code == code_val)
-            promo: PromoCode | None = db.execute(stmt).scalar_one_or_none()
-
-            if promo is None:
-                raise HTTPException(status_code=400, detail="invalid_code")
-
-            # 2) Expiry check
-            if promo.expires_at is not None and promo.expires_at <= now:
-                raise HTTPException(status_code=400, detail="expired")
-
-            # 3) Global max redemptions
-            if promo.redemptions_used >= promo.max_redemptions:
-                raise HTTPException(status_code=400, detail="max_redemptions")
-
-            # 4) Optional: block a device from reusing the same code
-            stmt2 = select(PromoRedemption).where(
-                PromoRedemption.promo_code_id == promo.id,
-                PromoRedemption.device_id == body.device_id,
-            )
-            already = db.execute(stmt2).scalar_one_or_none()
-            if already is not None:
-                raise HTTPException(status_code=400, detail="already_redeemed")
-
-            # 5) Record redemption
-            redemption = PromoRedemption(
-                promo_code_id=promo.id,
-                device_id=body.device_id,
-                redeemed_at=now,
-            )
-            db.add(redemption)
+    # Reject input that can't be a stored code before touching the pool
+    if not _is_well_formed_code(code_val):
+        raise HTTPException(status_code=400, detail="invalid_code")
 
-            promo.redemptions_used += 1
-            db.add(promo)
+    with _rejected_codes_lock:
+        rejected = _rejected_codes.get(code_val)
+    if rejected is not None:
+        raise HTTPException(status_code=400, detail=rejected)
 
-            db.commit()
+    try:
+        with engine.begin() as conn:
+            # 1) Claim a redemption slot atomically: validity, expiry and the
+            #    global cap are checked in the same statement as the
+            #    increment, so concurrent redeems can't overshoot the cap.
+            claimed = conn.execute(
+                _CLAIM_REDEMPTION_STMT, {"code": code_val, "now": now}
+            ).one_or_none()
+
+            if claimed is None:
+                # 2) Slow path only: work out why, for the error message
+                expires_at = conn.execute(
+                    _PROMO_EXPIRY_STMT, {"code": code_val}
+                ).one_or_none()
+                if expires_at is None:
+                    _reject(code_val, "invalid_code")
+                if expires_at[0] is not None and expires_at[0] <= now:
+                    _reject(code_val, "expired")
+                _reject(code_val, "max_redemptions")
+
+            # 3) Record redemption. uq_promo_device rejects a device reusing
+            #    the same code; leaving engine.begin() with an exception rolls
+            #    back the increment above.
+            try:
+                conn.execute(
+                    _INSERT_REDEMPTION_STMT,
+                    {
+                        "promo_code_id": claimed.id,
+                        "device_id": body.device_id,
+                        "redeemed_at": now,
+                    },
+                )
+            except IntegrityError:
+                raise HTTPException(status_code=400, detail="already_redeemed")
 
-            return PromoRedeemOut(
-                bonusQuestions=promo.bonus_questions,
-                expiresAt=promo.expires_at,
-            )
+        return PromoRedeemOut(
+            bonusQuestions=claimed.bonus_questions,
+            expiresAt=claimed.expires_at,
+        )
 
     except SQLAlchemyError:
         raise HTTPException(status_code=500, detail="server_error")
@@ -110,11 +172,24 @@ async def redeem_promo(body: PromoRedeemIn):
 # Simple admin HTML UI to create codes
 # --------------------------------------------------------------------
 
-def _random_code(prefix: str, length: int) -> str:
-    # Drop 0/O/1/I to avoid confusion
-    alphabet = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"
-    body = "".join(secrets.choice(alphabet) for _ in range(length))
-    return f"{prefix}{body}"
+# Drop 0/O/1/I to avoid confusion. Exactly 32 symbols, so the low 5 bits of
+# a random byte pick one uniformly (256 % 32 == 0, no rejection sampling).
+_CODE_ALPHABET = b"ABCDEFGHJKLMNPQRSTUVWXYZ23456789"
+_CODE_BYTE_TABLE = bytes(_CODE_ALPHABET[i & 0x1F] for i in range(256))
+
+
+_CREATE_CODES_ATTEMPTS = 3
+
+
+def _random_codes_batch(prefix: str, length: int, count: int) -> list[str]:
+    # One urandom read for the whole batch instead of a secrets.choice()
+    # call per character
+    raw = secrets.token_bytes(count * length)
+    chars = raw.translate(_CODE_BYTE_TABLE).decode("ascii")
+    return [
+        f"{prefix}{chars[i:i + length]}"
+        for i in range(0, count * length, length)
+    ]
 
 
 def _create_codes_in_db(
@@ -129,71 +204,90 @@ def _create_codes_in_db(
 ):
     codes: list[str] = []
 
-    with SessionLocal() as db:
-        for _ in range(count):
-            code_val = _random_code(prefix=prefix, length=code_length)
-
-            promo = PromoCode(
-                code=code_val,
-                bonus_questions=bonus_questions,
-                expires_at=expires_at,
-                max_redemptions=max_redemptions,
-                redemptions_used=0,
-                notes=note,
-            )
-            db.add(promo)
-            codes.append(code_val)
-
-        db.commit()
+    # Single transaction: either all `count` codes are created or none.
+    # Collisions with existing codes are skipped by ON CONFLICT DO NOTHING
+    # (a raised unique violation would abort the whole transaction); only
+    # the shortfall is regenerated and retried.
+    try:
+        with SessionLocal() as db, db.begin():
+            for _ in range(_CREATE_CODES_ATTEMPTS):
+                missing = count - len(codes)
+                if missing == 0:
+                    break
+
+                rows = [
+                    {
+                        "code": code_val,
+                        "bonus_questions": bonus_questions,
+                        "expires_at": expires_at,
+                        "max_redemptions": max_redemptions,
+                        "redemptions_used": 0,
+                        "notes": note,
+                    }
+                    for code_val in _random_codes_batch(
+                        prefix=prefix, length=code_length, count=missing
+                    )
+                ]
+
+                # One batched INSERT (executemany / insertmanyvalues) instead of
+                # a unit-of-work flush per row
+                stmt = (
+                    pg_insert(PromoCode)
+                    .on_conflict_do_nothing(index_elements=[PromoCode.code])
+                    .returning(PromoCode.code)
+                )
+                codes.extend(db.scalars(stmt, rows))
+
+            if len(codes) < count:
+                # Raising inside db.begin() rolls back the partial batch
+                raise HTTPException(status_code=500, detail="code_space_exhausted")
+    finally:
+        SessionLocal.remove()
 
     return codes
 
 
-@app.get("/admin", response_class=HTMLResponse)
-async def admin_form(token: str = Query(..., description="admin token")):
-    # Access: /admin?token=YOUR_TOKEN
-    require_admin(token)
-
-    # Minimal HTML – enough to generate codes safely
-    return f"""
+# Pages are built once at import; per request only the user-supplied values
+# are substituted (HTML-escaped). Minimal HTML – enough to generate codes safely.
+_ADMIN_FORM_TEMPLATE = """
 <!doctype html>
 <html>
   <head>
     <meta charset="utf-8">
     <title>Stablfy Promo Admin</title>
     <style>
-      body {{
+      body {
         font-family: system-ui, -apple-system, BlinkMacSystemFont, "Segoe UI", sans-serif;
         max-width: 640px;
         margin: 2rem auto;
         padding: 0 1rem;
-      }}
-      label {{
+      }
+      label {
         display: block;
         margin-top: 0.75rem;
-      }}
-      input[type="text"], input[type="number"] {{
+      }
+      input[type="text"], input[type="number"] {
         width: 100%;
         padding: 0.4rem;
         margin-top: 0.25rem;
-      }}
-      button {{
+      }
+      button {
         margin-top: 1rem;
         padding: 0.5rem 1.25rem;
-      }}
-      pre {{
+      }
+      pre {
         background: #111;
         color: #0f0;
         padding: 0.75rem;
         white-space: pre-wrap;
         word-break: break-all;
-      }}
+      }
     </style>
   </head>
   <body>
     <h1>Stablfy Promo Admin</h1>
     <form action="/admin/create" method="post">
-      <input type="hidden" name="token" value="{token}" />
+      <input type="hidden" name="token" value="__TOKEN__" />
 
       <label>
         Prefix (optional)
@@ -236,9 +330,46 @@ async def admin_form(token: str = Query(..., description="admin token")):
 </html>
 """
 
+# The create page is streamed: head plus the first committed chunk, then the
+# remaining chunks as each commits, then the summary. The heading stays
+# neutral since a later chunk can still fail.
+_ADMIN_CREATE_HEAD_TEMPLATE = Template("""
+<!doctype html>
+<html>
+  <head>
+    <meta charset="utf-8">
+    <title>Promo codes</title>
+  </head>
+  <body>
+    <h1>Promo codes</h1>
+    <p><strong>Bonus per code:</strong> $bonus_questions</p>
+    <p><strong>Max redemptions per code:</strong> $max_redemptions</p>
+    <p><strong>Note:</strong> $note </p>
+    <pre>""")
+
+_ADMIN_CREATE_TAIL_TEMPLATE = Template("""</pre>
+    $error
+    <p>Created <strong>$count</strong> codes.</p>
+
+    <p><a href="/admin?token=$token_query">Create more</a></p>
+  </body>
+</html>
+""")
+
+# Rows per INSERT/commit when streaming; PostgreSQL gains little past ~1000
+_ADMIN_CREATE_CHUNK_SIZE = 500
+
+
+@app.get("/admin", response_class=HTMLResponse)
+async def admin_form(token: str = Query(..., description="admin token")):
+    # Access: /admin?token=YOUR_TOKEN
+    require_admin(token)
+
+    return _ADMIN_FORM_TEMPLATE.replace("__TOKEN__", html.escape(token))
+
 
 @app.post("/admin/create", response_class=HTMLResponse)
-async def admin_create(
+def admin_create(
     token: str = Form(...),
     prefix: str = Form("STAB"),
     count: int = Form(10),
@@ -250,6 +381,24 @@ async def admin_create(
 ):
     require_admin(token)
 
+    # Redeem uppercases input, so a lowercase prefix would produce codes
+    # that can never be redeemed
+    prefix = prefix.strip().upper()
+
+    # Mirror the form's min/max limits server-side: once the response starts
+    # streaming, bad input can no longer be turned into a 400
+    if not 1 <= count <= 1000:
+        raise HTTPException(status_code=400, detail="invalid_count")
+    if bonus_questions < 1:
+        raise HTTPException(status_code=400, detail="invalid_bonus_questions")
+    if max_redemptions < 1:
+        raise HTTPException(status_code=400, detail="invalid_max_redemptions")
+    if not 4 <= code_length <= 16:
+        raise HTTPException(status_code=400, detail="invalid_code_length")
+    if len(prefix) + code_length > 64:
+        # promo_codes.code is String(64)
+        raise HTTPException(status_code=400, detail="code_too_long")
+
     expires_at: datetime | None = None
     if expires_date.strip():
         try:
@@ -259,34 +408,56 @@ async def admin_create(
         except ValueError:
             raise HTTPException(status_code=400, detail="invalid_expires_date")
 
-    codes = _create_codes_in_db(
-        count=count,
-        bonus_questions=bonus_questions,
-        max_redemptions=max_redemptions,
-        note=note,
-        prefix=prefix,
-        code_length=code_length,
-        expires_at=expires_at,
-    )
-
-    codes_block = "\n".join(codes)
-
-    return f"""
-<!doctype html>
-<html>
-  <head>
-    <meta charset="utf-8">
-    <title>Codes created</title>
-  </head>
-  <body>
-    <h1>Codes created</h1>
-    <p>Created <strong>{len(codes)}</strong> codes.</p>
-    <p><strong>Bonus per code:</strong> {bonus_questions}</p>
-    <p><strong>Max redemptions per code:</strong> {max_redemptions}</p>
-    <p><strong>Note:</strong> {note or "(none)"} </p>
-    <pre>{codes_block}</pre>
-
-    <p><a href="/admin?token={token}">Create more</a></p>
-  </body>
-</html>
-"""
+    def create_chunk(created: int) -> list[str]:
+        # Each chunk is its own transaction, so codes are only shown once
+        # they are committed
+        codes = _create_codes_in_db(
+            count=min(_ADMIN_CREATE_CHUNK_SIZE, count - created),
+            bonus_questions=bonus_questions,
+            max_redemptions=max_redemptions,
+            note=note,
+            prefix=prefix,
+            code_length=code_length,
+            expires_at=expires_at,
+        )
+
+        # New codes may have been tried (and cached as invalid) before they
+        # existed
+        with _rejected_codes_lock:
+            for code_val in codes:
+                _rejected_codes.pop(code_val, None)
+
+        return codes
+
+    # First chunk before any bytes are sent, so a DB outage or
+    # code_space_exhausted still surfaces as a real error status
+    first_codes = create_chunk(0)
+
+    def generate():
+        yield _ADMIN_CREATE_HEAD_TEMPLATE.substitute(
+            bonus_questions=bonus_questions,
+            max_redemptions=max_redemptions,
+            note=html.escape(note or "(none)"),
+        )
+        yield html.escape("\n".join(first_codes)) + "\n"
+
+        created = len(first_codes)
+        error = ""
+        try:
+            while created < count:
+                codes = create_chunk(created)
+                created += len(codes)
+                yield html.escape("\n".join(codes)) + "\n"
+        except (HTTPException, SQLAlchemyError):
+            # Headers are already sent; report in-page instead
+            error = "<p><strong>Error:</strong> stopped early, see count below.</p>"
+
+        yield _ADMIN_CREATE_TAIL_TEMPLATE.substitute(
+            error=error,
+            count=created,
+            token_query=html.escape(quote_plus(token)),
+        )
+
+    # Sync generator: Starlette iterates it in the threadpool, so the
+    # blocking inserts stay off the event loop
+    return StreamingResponse(generate(), media_type="text/html")
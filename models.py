@@ -1,6 +1,6 @@
 # models.py
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Index, UniqueConstraint
 from sqlalchemy.orm import declarative_base, relationship
 
 Base = declarative_base()
@@ -8,9 +8,21 @@ Base = declarative_base()
 
 class PromoCode(Base):
     __tablename__ = "promo_codes"
+    __table_args__ = (
+        # Unique lookup index on code, covering the columns read alongside it
+        # so the lookup is an index-only scan on PG 11+. redemptions_used is
+        # left out on purpose: it changes on every redeem, and indexing it
+        # would rule out HOT updates.
+        Index(
+            "ix_promo_codes_code_covering",
+            "code",
+            unique=True,
+            postgresql_include=["bonus_questions", "expires_at", "max_redemptions"],
+        ),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
-    code = Column(String(64), unique=True, index=True, nullable=False)
+    code = Column(String(64), nullable=False)
     bonus_questions = Column(Integer, nullable=False)
     expires_at = Column(DateTime(timezone=True), nullable=True)
 
@@ -19,15 +31,25 @@ class PromoCode(Base):
 
     notes = Column(String(255), nullable=True)
 
-    redemptions = relationship("PromoRedemption", back_populates="promo_code")
+    # lazy="raise": no implicit per-row loads (N+1); opt in with
+    # .options(selectinload(PromoCode.redemptions)) where needed
+    redemptions = relationship(
+        "PromoRedemption", back_populates="promo_code", lazy="raise"
+    )
 
 
 class PromoRedemption(Base):
     __tablename__ = "promo_redemptions"
+    __table_args__ = (
+        # One redemption per device per code, enforced by the DB
+        UniqueConstraint("promo_code_id", "device_id", name="uq_promo_device"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     promo_code_id = Column(Integer, ForeignKey("promo_codes.id"), nullable=False)
     device_id = Column(String(128), nullable=False, index=True)
     redeemed_at = Column(DateTime(timezone=True), nullable=False)
 
-    promo_code = relationship("PromoCode", back_populates="redemptions")
+    promo_code = relationship(
+        "PromoCode", back_populates="redemptions", lazy="raise"
+    )